@@ -659,6 +659,16 @@ class ClientConfig(Config):
 
         stats_on_smooth_grad (bool): When true, gradient statistics are reset each round. Currently, it appears these statistics aren't used.
 
+        keep_on_device (bool): When true, FedLabels payloads stay on the client GPU instead of being staged through host memory. This only skips client-side staging, the server still receives payloads on the host and uploads them again for aggregation. Meant for single-node runs.
+
+        bucket_cap_mb (float): Size of the buckets used to pack FedLabels payloads before copying them to host memory.
+
+        compress (str): How FedLabels payloads are compressed before being sent to the server. One of
+
+            - none
+            - bf16
+            - int8
+
         ignore_subtask (bool): Used to determine which model loss to use. In most cases just set to False.
 
         num_skips_threshold (int): previously used to skip users, deprecated.
@@ -679,6 +689,9 @@ class ClientConfig(Config):
     """
     meta_learning: str = None
     stats_on_smooth_grad: bool = False
+    keep_on_device: bool = False
+    bucket_cap_mb: float = 25
+    compress: str = 'none'
     ignore_subtask: bool = False
     num_skips_threshold: int | None = None
     copying_train_data: bool = False
@@ -12,7 +12,7 @@ import numpy as np
 # Internal imports
 import core.federated as federated
 from core.client import Client
-from utils import print_rank
+from utils import CPU, print_rank
 
 # AzureML-related libs
 from azureml.core import Run
@@ -44,9 +44,9 @@ class Evaluation():
         
         self.worker_trainer = req['worker_trainer']
         if self.send_dicts:
-            global_model_values = [self.worker_trainer.model.state_dict()[param_key].to(torch.device('cpu')) for param_key in self.worker_trainer.model.state_dict()]
+            global_model_values = [value.to(CPU) for value in self.worker_trainer.model.state_dict().values()]
         else:
-            global_model_values = [p.data.to(torch.device('cpu')) for p in self.worker_trainer.model.parameters()]
+            global_model_values = [p.data.to(CPU) for p in self.worker_trainer.model.parameters()]
 
         if 'tmp_unsup' in req:
             unsup_values = req['tmp_unsup'].values()
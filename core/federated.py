@@ -22,6 +22,9 @@ COMMAND_TERMINATE = 10
 COMMAND_TESTVAL = 11
 COMMAND_SYNC_NODES = 9
 
+# Data types preserved by `_send_gradients`, tensors of any other type are sent as float32
+TENSOR_DTYPES = [torch.float32, torch.float16, torch.bfloat16, torch.int8]
+
 def encode_string(word, string_to_int = True):
     """ Encodes/Decodes the dictionary keys into an array of integers to be sent 
     as tensors of the same shape during NCCL/Gloo P2P communication.
@@ -76,8 +79,10 @@ def _recv_gradients(src):
         n_dimensions = _recv(n_dimensions,src)
         dimensions = [0 for i in range(n_dimensions)]
         dimensions = _recv(dimensions, src)
+        dimensions = dimensions if isinstance(dimensions, list) else [dimensions] # single element comes back as a scalar
+        dtype = dimensions.pop() # dtype code travels as the last element of the dimensions
         print_rank(f"Received dimensions {dimensions}", loglevel=logging.DEBUG)
-        param = to_device(torch.zeros(dimensions))
+        param = to_device(torch.zeros(dimensions, dtype=TENSOR_DTYPES[dtype]))
         print_rank(f"Shape assigned {param.shape}", loglevel=logging.DEBUG)
         dist.recv(param,src)
         grads.append(param.detach().cpu())
@@ -113,7 +118,8 @@ def _send_gradients(gradients, dst):
 
     _send(len(gradients), dst)
     for i in gradients:
-        dimensions = [int(d) for d in i.shape]
+        i = i if i.dtype in TENSOR_DTYPES else i.float()
+        dimensions = [int(d) for d in i.shape] + [TENSOR_DTYPES.index(i.dtype)] # dtype code appended to the shape
         _send(len(dimensions),dst)
         _send(dimensions,dst)
         param = to_device(i)
@@ -227,6 +227,9 @@
         'schema': {
             'meta_learning': {'required': False, 'type':'string'},
             'stats_on_smooth_grad': {'required': False, 'type':'boolean'},
+            'keep_on_device': {'required': False, 'type':'boolean'},
+            'bucket_cap_mb': {'required': False, 'type':'number'},
+            'compress': {'required': False, 'type':'string', 'allowed':['none', 'bf16', 'int8']},
             'ignore_subtask': {'required': True, 'type':'boolean'},
             'num_skips_threshold': {'required': False, 'type':'integer'},
             'copying_train_data': {'required': False, 'type':'boolean'},
@@ -29,6 +29,7 @@ from .trainer import (
     set_component_wise_lr,
 )
 from utils import (
+    CPU,
     get_lr,
     print_rank,
     update_json_log,
@@ -282,9 +283,9 @@ class OptimizationServer(federated.Server):
                 self.train_loss = []
 
                 if self.send_dicts: # Send state dictionaries
-                    glob_payload = [self.worker_trainer.model.state_dict()[param_key].to(torch.device('cpu')) for param_key in self.worker_trainer.model.state_dict()]
+                    glob_payload = [value.to(CPU) for value in self.worker_trainer.model.state_dict().values()]
                 else: # Send parameters
-                    glob_payload = [p.data.to(torch.device('cpu')) for p in self.worker_trainer.model.parameters()]
+                    glob_payload = [p.data.to(CPU) for p in self.worker_trainer.model.parameters()]
                 
                 server_data = (initial_lr, glob_payload, i)
 
@@ -462,6 +463,7 @@ class OptimizationServer(federated.Server):
                     print_rank('Running {} at itr={}'.format(eval_list,i+1))
                     self.metrics['worker_trainer'] = self.worker_trainer
                     if hasattr(self.strategy,'tmp_unsup'):
+                        # FedLabels hands out views on its accumulators, only valid until the next round starts
                         self.metrics['tmp_sup'] = self.strategy.tmp_sup
                         self.metrics['tmp_unsup'] = self.strategy.tmp_unsup
                     self.metrics = self.evaluation.run(eval_list, self.metrics, metric_logger=run.log)
@@ -6,12 +6,14 @@ from .fedavg import FedAvg
 from .dga import DGA
 from .fedlabels import FedLabels
 
+_STRATEGIES = {
+    'dga': DGA,
+    'fedavg': FedAvg,
+    'fedlabels': FedLabels,
+}
+
 def select_strategy(strategy):
-    if strategy.lower() == 'dga':
-        return DGA
-    elif strategy.lower() == 'fedavg':
-        return FedAvg
-    elif strategy.lower() == 'fedlabels':
-        return FedLabels
-    else:
-        raise ValueError(f'cannot use strategy f{strategy}')
\ No newline at end of file
+    try:
+        return _STRATEGIES[strategy.lower()]
+    except KeyError:
+        raise ValueError(f'cannot use strategy {strategy}') from None
\ No newline at end of file
@@ -11,7 +11,7 @@ import numpy as np
 import torch
 
 from extensions import privacy, RL, quant_model
-from utils import compute_grad_cosines, print_rank, to_device
+from utils import CPU, compute_grad_cosines, print_rank, to_device
 from core.strategies import BaseStrategy
 from core.strategies.utils import (
     aggregate_gradients_inplace,
@@ -150,7 +150,7 @@ class DGA(BaseStrategy):
 
         payload = {}
         payload['weight'] = weight
-        payload['gradients'] = [p.grad.to(torch.device('cpu')) for p in trainer.model.parameters()]
+        payload['gradients'] = [p.grad.to(CPU) for p in trainer.model.parameters()]
 
         return payload
 
@@ -7,7 +7,7 @@ import os
 
 import torch
 
-from utils import compute_grad_cosines, print_rank
+from utils import CPU, compute_grad_cosines, print_rank
 from core.strategies import BaseStrategy
 from core.strategies.utils import (
     aggregate_gradients_inplace,
@@ -86,7 +86,7 @@ class FedAvg(BaseStrategy):
 
         payload = {}
         payload['weight'] = weight
-        payload['gradients'] = [p.grad.to(torch.device('cpu')) for p in trainer.model.parameters()]
+        payload['gradients'] = [p.grad.to(CPU) for p in trainer.model.parameters()]
 
         return payload
 
@@ -6,8 +6,8 @@ import logging
 import os
 
 import torch
-import numpy as np
 from azureml.core import Run
+from torch._utils import _flatten_dense_tensors
 
 from core.strategies import BaseStrategy
 from utils import (
@@ -17,6 +17,10 @@ from utils import (
 
 run = Run.get_context()
 
+# Pinned host staging buffer reused across rounds by the client, and the stream copying into it
+_host_buffer = None
+_copy_stream = None
+
 class FedLabels(BaseStrategy):
     '''FedLabels: Semi-supervision strategy.'''
 
@@ -47,15 +51,29 @@ class FedLabels(BaseStrategy):
 
         if mode == 'client':
             self.stats_on_smooth_grad = self.client_config.get('stats_on_smooth_grad', False)
+            self.keep_on_device = self.client_config.get('keep_on_device', False)
+            self.bucket_cap_mb = self.client_config.get('bucket_cap_mb', 25)
+            self.compress = self.client_config.get('compress', 'none')
         elif mode == 'server':
             self.dump_norm_stats = self.config.get('dump_norm_stats', False)
-            self.aggregate_fast = self.server_config.get('fast_aggregation', False)
 
             self.skip_model_update = False
 
-            # Initialize accumulators
+            # Initialize accumulators, payloads are only stacked when needed for norm stats.
+            # Flat sup/unsup buffers are allocated on the first payload and reused every round.
             self.client_parameters_stack = []
             self.client_weights = []
+            self._tmp_sup_flat = None
+            self._tmp_unsup_flat = None
+
+            # Model topology is static across rounds, so keys/shapes are collected only once
+            self._state_layout = None
+            self._payload_numels = None
+
+            # Client buffers are uploaded and summed on side streams, overlapping with the next receive.
+            # Sup and unsup passes are independent, so each gets its own stream and they run concurrently.
+            self._sup_stream = torch.cuda.Stream() if torch.cuda.is_available() else None
+            self._unsup_stream = torch.cuda.Stream() if torch.cuda.is_available() else None
 
     def generate_client_payload(self, trainer):
         '''Generate client payload
@@ -67,7 +85,10 @@ class FedLabels(BaseStrategy):
             total_est_labels (int): labels generated
 
         Returns:
-            dict containing payloads in some specified format.
+            dict containing payloads in some specified format. When
+            staged through host memory, the gradients share a pinned
+            buffer that the next call overwrites, so the payload must be
+            sent before another one is generated.
         '''
 
         unsup_dict = trainer.algo_computation
@@ -82,12 +103,24 @@ class FedLabels(BaseStrategy):
 
         # Weight the gradient and preprocess state dictionaries from supervised and unsupervised model
         weight = 1 if trainer.num_samples == 0 else trainer.num_samples
-        unsup_grads = [unsup_dict[param_tensor].to(torch.device('cpu')) for param_tensor in unsup_dict.keys()]
-        sup_grads = [trainer.model.state_dict()[param_tensor].to(torch.device('cpu')) for param_tensor in trainer.model.state_dict().keys()]
+
+        # Both models are fused into one flat float buffer (sup first, then unsup), so they cross
+        # to the CPU and over the wire as a single tensor. Keys and shapes are never sent, the
+        # server already knows them from its own copy of the model.
+        model_dict = trainer.model.state_dict()
+        values = [value.float() for value in model_dict.values()] + [unsup_dict[param_key].float() for param_key in model_dict]
+        stage_to_host = torch.cuda.is_available() and not self.keep_on_device
+        if self.compress == 'none' and stage_to_host:
+            gradients = [flatten_to_host(values, self.bucket_cap_mb)]
+        else:
+            # Compress on the device, so only the compressed data and its scales cross to the host
+            gradients = compress_payload(_flatten_dense_tensors(values), self.compress, [value.numel() for value in values])
+            if stage_to_host:
+                gradients = [flatten_to_host(gradients[:1], self.bucket_cap_mb)] + [g.cpu() for g in gradients[1:]]
 
         payload = {}
         payload['weight'] = weight
-        payload['gradients'] = sup_grads + unsup_grads
+        payload['gradients'] = gradients
 
         return payload
 
@@ -110,11 +143,27 @@ class FedLabels(BaseStrategy):
         if payload['weight'] == 0.0:
             return False
 
+        if self._state_layout is None:
+            self._state_layout = tuple((key, value.shape) for key, value in worker_trainer.model.state_dict().items())
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+            self._payload_numels = torch.tensor([shape.numel() for _, shape in self._state_layout] * 2, device=device)
+            numel = sum(shape.numel() for _, shape in self._state_layout)
+            self._tmp_sup_flat = torch.zeros(numel, device=device)
+            self._tmp_unsup_flat = torch.zeros(numel, device=device)
+        elif not self.client_weights:
+            # First client of the round, clear what was left by the previous one
+            self._tmp_sup_flat.zero_()
+            self._tmp_unsup_flat.zero_()
         self.client_weights.append(payload['weight'])
-        if self.aggregate_fast:
-            aggregate_gradients_inplace(worker_trainer.model, payload['gradients'])
-        else:
-            self.client_parameters_stack.append(payload['gradients'])
+
+        # Sum right away, so the server holds a single copy of each model whatever the
+        # number of clients. Normalization by the total weight is deferred to `_aggregate_gradients`.
+        flat = decompress_payload(payload['gradients'], self._payload_numels)
+        sup_flat, unsup_flat = flat.chunk(2)
+        self._accumulate(sup_flat, unsup_flat, 1.0, payload['weight'])
+        if self.dump_norm_stats:
+            # Stacked on the CPU, next to the gradients the cosines are computed against
+            self.client_parameters_stack.append(flat.cpu())
         return True
 
     def combine_payloads(self, worker_trainer, curr_iter, num_clients_curr_iter, total_clients, client_stats, logger=None):
@@ -137,15 +186,23 @@ class FedLabels(BaseStrategy):
 
         # Aggregation step
         if self.dump_norm_stats:
-            cps_copy = [[g.clone().detach() for g in x] for x in self.client_parameters_stack]
-        weight_sum, self.tmp_sup, self.tmp_unsup = self._aggregate_gradients(worker_trainer, num_clients_curr_iter, self.client_weights, metric_logger=logger)
+            # Payloads are never written to after arrival, so per-key views are enough, no need to clone
+            cps_copy = [
+                [value for flat in x.chunk(2) for value in unflatten_state_dict(flat, self._state_layout).values()]
+                for x in self.client_parameters_stack
+            ]
+        weight_sum, tmp_sup_flat, tmp_unsup_flat = self._aggregate_gradients(worker_trainer, num_clients_curr_iter, self.client_weights, metric_logger=logger)
         print_rank('Sum of weights: {}'.format(weight_sum), loglevel=logging.DEBUG)
-        torch.cuda.empty_cache()
 
-        # Disjoint aggregation
-        tmp_both = {}
-        for param_key in self.tmp_unsup.keys():
-                tmp_both[param_key] = self.tmp_sup[param_key]/2 + self.tmp_unsup[param_key]/2
+        # Sup/unsup dictionaries are kept as views on the flat buffers for evaluation,
+        # they are zeroed and refilled in place when the next round starts
+        self.tmp_sup = unflatten_state_dict(tmp_sup_flat, self._state_layout)
+        self.tmp_unsup = unflatten_state_dict(tmp_unsup_flat, self._state_layout)
+
+        # Disjoint aggregation, blended out of place since sup/unsup views are still needed.
+        # lerp at 0.5 gives the 50/50 average in a single fused kernel.
+        tmp_both_flat = torch.lerp(tmp_sup_flat, tmp_unsup_flat, 0.5)
+        tmp_both = unflatten_state_dict(tmp_both_flat, self._state_layout)
         worker_trainer.model.load_state_dict(tmp_both)
         
         if self.dump_norm_stats:
@@ -168,7 +225,7 @@ class FedLabels(BaseStrategy):
         return losses
 
     def _aggregate_gradients(self, worker_trainer, num_clients_curr_iter, client_weights, metric_logger=None):
-        '''Go through stored gradients, aggregate and put them inside model.
+        '''Normalize the models summed on arrival by the client weights.
 
         Args:
             num_clients_curr_iter (int): how many clients were processed.
@@ -178,58 +235,169 @@ class FedLabels(BaseStrategy):
 
         Returns:
             float: sum of weights for all clients.
-            dict: supervised model state dictionary.
-            dict: unsupervised model state dicionary.
+            torch.Tensor: flat supervised model parameters.
+            torch.Tensor: flat unsupervised model parameters.
         '''
 
         if metric_logger is None:
             metric_logger = run.log
 
-        # Separate sup/unsup dictionaries from client payload
-        sup_slice = int(len(self.client_parameters_stack[0])/2)
-        keys = [key for key in worker_trainer.model.state_dict()]
-        model_dicts = [client_dict[:sup_slice] for client_dict in self.client_parameters_stack]
-        unsup_dicts = [client_dict[sup_slice:] for client_dict in self.client_parameters_stack]
-
-        first = True
-        tmp_sup, tmp_unsup = {}, {}
-
         # Compute radios for each model
         weight_sum = sum(client_weights)
         ratio_sup = 1/len(client_weights)
-        ratio_unsup = np.array(client_weights)/weight_sum
-
-        if not self.aggregate_fast:
-            # Perform aggregation for supervised model
-            for i, client_parameters in enumerate(model_dicts):
-                first, tmp_sup = aggregate_gradients_inplace(keys, client_parameters, first, tmp_sup, ratio_sup)
-            first = True
-            
-            # Perform aggregation for unsupervised model
-            for j, client_parameters in enumerate(unsup_dicts):
-                first, tmp_unsup = aggregate_gradients_inplace(keys, client_parameters, first, tmp_unsup, ratio_unsup[j])
-        
+        ratio_unsup = 1/weight_sum
+
+        # Payloads were already summed on arrival, only normalization is left
+        with torch.cuda.stream(self._sup_stream):
+            self._tmp_sup_flat.mul_(ratio_sup)
+        with torch.cuda.stream(self._unsup_stream):
+            self._tmp_unsup_flat.mul_(ratio_unsup)
+
+        # Accumulators must not be read before the aggregation streams are done
+        if torch.cuda.is_available():
+            torch.cuda.current_stream().wait_stream(self._sup_stream)
+            torch.cuda.current_stream().wait_stream(self._unsup_stream)
+
         # Some cleaning
         self.client_parameters_stack = []
         self.client_weights = []
 
-        return weight_sum, tmp_sup, tmp_unsup
+        return weight_sum, self._tmp_sup_flat, self._tmp_unsup_flat
 
-def aggregate_gradients_inplace(keys, values, first, tmp, ratio):
-    '''Aggregate list of tensors into model dictionary.
+    def _accumulate(self, sup_flat, unsup_flat, ratio_sup, ratio_unsup):
+        '''Add one client's flat buffers into the accumulators on the aggregation streams.
+
+        Args:
+            sup_flat (torch.Tensor): flat supervised model from the client.
+            unsup_flat (torch.Tensor): flat unsupervised model from the client.
+            ratio_sup (float): weight of the supervised model.
+            ratio_unsup (float): weight of the unsupervised model.
+        '''
+
+        passes = (
+            (self._sup_stream, self._tmp_sup_flat, sup_flat, ratio_sup),
+            (self._unsup_stream, self._tmp_unsup_flat, unsup_flat, ratio_unsup),
+        )
+        for stream, tmp, values, ratio in passes:
+            if stream is not None:
+                # Accumulators and device payloads are produced on the current stream
+                stream.wait_stream(torch.cuda.current_stream())
+                if values.is_cuda:
+                    values.record_stream(stream)
+            with torch.cuda.stream(stream):
+                aggregate_gradients_inplace(tmp, values, ratio)
+
+def aggregate_gradients_inplace(tmp, values, ratio):
+    '''Aggregate a flat client buffer into the flat model buffer, in place.
 
     Args:
-        keys (list): state dictionary keys of model to which dictionaries will be summed.
-        values (list): list of values to sum to model dictionary.
-        first (bool): flag that indicates the first value in the dictionary.
-        tmp (dict): model state dictionary that will be summed.
+        tmp (torch.Tensor): flat model buffer that will be summed.
+        values (torch.Tensor): flat client buffer to sum to the model buffer.
         ratio (float): radio to weight each client value.
     '''
 
-    for param_key, client_dict in zip (keys, values):
-        if first:
-            tmp[param_key] = to_device(client_dict) * ratio
-        else:
-            tmp[param_key] += to_device(client_dict) * ratio
+    tmp.add_(values.to(tmp.device, non_blocking=True), alpha=ratio)
+
+def unflatten_state_dict(flat, layout):
+    '''Split a flat buffer back into a state dictionary of views.
+
+    Args:
+        flat (torch.Tensor): flat buffer, as generated by the client.
+        layout (tuple): pairs of state dictionary key and tensor shape.
+    '''
+
+    chunks = flat.split([shape.numel() for _, shape in layout])
+    return {key: chunk.view(shape) for (key, shape), chunk in zip(layout, chunks)}
+
+def compress_payload(flat, compress, numels):
+    '''Compress a flat payload before it is sent to the server.
+
+    Args:
+        flat (torch.Tensor): flat float buffer.
+        compress (str): one of :code:`none`, :code:`bf16` or :code:`int8`.
+            For :code:`int8`, every tensor packed in the buffer gets its own
+            symmetric quantization scale.
+        numels (list): number of elements of each tensor in the buffer.
+
+    Returns:
+        list of tensors to be used as payload gradients.
+    '''
+
+    if compress == 'bf16':
+        return [flat.to(torch.bfloat16)]
+    elif compress == 'int8':
+        # Empty tensors get a zero scale, `max` is not defined on them
+        scales = torch.stack([chunk.abs().max() if chunk.numel() else chunk.new_zeros(()) for chunk in flat.split(numels)]) / 127
+        scales.clamp_(min=torch.finfo(torch.float32).tiny)
+        quantized = (flat / scales.repeat_interleave(torch.tensor(numels, device=flat.device))).round_().to(torch.int8)
+        return [quantized, scales]
+    elif compress == 'none':
+        return [flat]
+    raise ValueError(f'cannot use payload compression {compress}')
+
+def decompress_payload(gradients, numels):
+    '''Recover the flat float buffer generated by :code:`compress_payload`.
+
+    Args:
+        gradients (list): payload gradients, as received by the server.
+        numels (torch.Tensor): number of elements of each tensor in the buffer,
+            on the server device.
+    '''
+
+    if len(gradients) == 2:
+        quantized, scales = [to_device(g) for g in gradients]
+        return quantized.float().mul_(scales.repeat_interleave(numels))
+    elif gradients[0].dtype != torch.float32:
+        return to_device(gradients[0]).float()
+    return gradients[0]
+
+def flatten_to_host(tensors, bucket_cap_mb):
+    '''Pack tensors into a reusable pinned host buffer, one bucket at a time.
+
+    Tensors are grouped into buckets of about :code:`bucket_cap_mb`, each bucket
+    is flattened on the current stream and copied to its slice of the host
+    buffer on a dedicated copy stream, so the copy of a bucket overlaps with
+    packing the next one and the device only holds a couple of buckets of
+    extra memory. The copies are finished when the function returns, and the
+    buffer is only valid until the next call.
+
+    Args:
+        tensors (list): tensors of the same dtype to be packed, in order.
+        bucket_cap_mb (float): approximate size of each bucket, in MB.
+    '''
 
-    return False, tmp
\ No newline at end of file
+    global _host_buffer, _copy_stream
+    numel = sum(t.numel() for t in tensors)
+    dtype = tensors[0].dtype
+    if _host_buffer is None or _host_buffer.numel() != numel or _host_buffer.dtype != dtype:
+        _host_buffer = torch.empty(numel, dtype=dtype, pin_memory=torch.cuda.is_available())
+    buffer = _host_buffer
+
+    copy_stream = None
+    if any(t.is_cuda for t in tensors):
+        if _copy_stream is None:
+            _copy_stream = torch.cuda.Stream()
+        copy_stream = _copy_stream
+        current_stream = torch.cuda.current_stream()
+
+    bucket_cap = int(bucket_cap_mb * 1024 * 1024) // buffer.element_size()
+    bucket, bucket_numel, offset = [], 0, 0
+    for i, t in enumerate(tensors):
+        bucket.append(t)
+        bucket_numel += t.numel()
+        if bucket_numel >= bucket_cap or i == len(tensors) - 1:
+            packed = _flatten_dense_tensors(bucket)
+            if copy_stream is None:
+                buffer[offset:offset + bucket_numel].copy_(packed)
+            else:
+                # Wait for the bucket to be packed, and keep its memory alive until copied
+                copy_stream.wait_stream(current_stream)
+                with torch.cuda.stream(copy_stream):
+                    buffer[offset:offset + bucket_numel].copy_(packed, non_blocking=True)
+                packed.record_stream(copy_stream)
+            offset += bucket_numel
+            bucket, bucket_numel = [], 0
+
+    if copy_stream is not None:
+        copy_stream.synchronize()
+    return buffer
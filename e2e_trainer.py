@@ -135,9 +135,11 @@ def run_worker(model_path, config, task, data_path, local_rank, backend):
             # Load a model that's already trained
             best_trained_model = find_pretrained_model(model_path, model_config)
             if best_trained_model is not None:
-                model_state_dict = torch.load(best_trained_model,
-                    map_location=None if torch.cuda.is_available() else torch.device("cpu"))
+                # The model is already on its device, map the checkpoint to the CPU so the weights are
+                # never held twice on the GPU, and release it as soon as they are copied in
+                model_state_dict = torch.load(best_trained_model, map_location=torch.device("cpu"))
                 model.load_state_dict(model_state_dict)
+                del model_state_dict
 
             server_type = server_config["type"]
             server_setup = select_server(server_type)  # Return the server class
@@ -0,0 +1,114 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import copy
+import json
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core.strategies.fedlabels import FedLabels
+
+def make_strategy(mode, model_path=None, dump_norm_stats=False, compress='none'):
+
+    config = {
+        'model_config': {},
+        'client_config': {'compress': compress},
+        'server_config': {},
+        'dump_norm_stats': dump_norm_stats,
+    }
+    return FedLabels(mode, config, model_path=model_path)
+
+def make_client(model, num_samples, compress='none'):
+    '''Generate a client payload, along with the sup/unsup models it was built from.'''
+
+    sup = {key: torch.randn_like(value) for key, value in model.state_dict().items()}
+    unsup = {key: torch.randn_like(value) for key, value in model.state_dict().items()}
+    client_model = copy.deepcopy(model)
+    client_model.load_state_dict(sup)
+
+    trainer = SimpleNamespace(model=client_model, algo_computation=unsup, num_samples=num_samples)
+    payload = make_strategy('client', compress=compress).generate_client_payload(trainer)
+
+    # Staged payloads share the host buffer, clone them as if they had been sent
+    payload['gradients'] = [g.clone() for g in payload['gradients']]
+    return payload, sup, unsup
+
+class ServerTrainer:
+    '''Minimal stand-in for the server side trainer.'''
+
+    def __init__(self, model):
+        self.model = model
+        self.updates = 0
+
+    def update_model(self):
+        self.updates += 1
+
+    def run_lr_scheduler(self, force_run_val=False):
+        return []
+
+def run_round(strategy, trainer, payloads):
+
+    processed = [strategy.process_individual_payload(trainer, payload) for payload in payloads]
+    strategy.combine_payloads(trainer, 0, len(payloads), len(payloads), {}, logger=lambda *args, **kwargs: None)
+    return processed
+
+@pytest.mark.parametrize('compress', ['bf16', 'int8'])
+def test_norm_stats_with_compression(tmp_path, compress):
+
+    torch.manual_seed(0)
+    model = torch.nn.Linear(3, 2)
+    for p in model.parameters():
+        p.grad = torch.randn_like(p)
+
+    strategy = make_strategy('server', model_path=str(tmp_path), dump_norm_stats=True)
+    trainer = ServerTrainer(model)
+    payloads = [make_client(model, num_samples, compress)[0] for num_samples in (2, 5)]
+    for payload in payloads:
+        assert strategy.process_individual_payload(trainer, payload)
+
+    # Dequantized payloads are kept on the CPU, whatever device they were summed on
+    assert len(strategy.client_parameters_stack) == len(payloads)
+    assert all(not flat.is_cuda for flat in strategy.client_parameters_stack)
+
+    strategy.combine_payloads(trainer, 0, len(payloads), len(payloads), {}, logger=lambda *args, **kwargs: None)
+    with open(os.path.join(str(tmp_path), 'cosines.txt'), encoding='utf-8') as f:
+        cosines = [json.loads(line) for line in f]
+    assert len(cosines) == 1
+    assert len(cosines[0]) == len(payloads)
+
+def test_aggregation_matches_baseline():
+
+    torch.manual_seed(0)
+    model = torch.nn.Linear(3, 2)
+    strategy = make_strategy('server')
+    trainer = ServerTrainer(model)
+
+    for _ in range(2):
+        clients = [make_client(model, num_samples) for num_samples in (3, 1, 6)]
+        payloads = [payload for payload, _, _ in clients]
+
+        # Zero-weight clients are rejected and must not affect the aggregate
+        skipped = copy.deepcopy(payloads[0])
+        skipped['weight'] = 0.0
+        processed = run_round(strategy, trainer, payloads + [skipped])
+        assert processed == [True, True, True, False]
+
+        # Baseline: plain mean of sup models, sample-weighted mean of unsup models, blended 50/50
+        weight_sum = sum(payload['weight'] for payload in payloads)
+        for key, value in model.state_dict().items():
+            sup = sum(s[key] for _, s, _ in clients) / len(clients)
+            unsup = sum(payload['weight'] / weight_sum * u[key] for payload, _, u in clients)
+            assert torch.allclose(strategy.tmp_sup[key].cpu(), sup, atol=1e-6)
+            assert torch.allclose(strategy.tmp_unsup[key].cpu(), unsup, atol=1e-6)
+            assert torch.allclose(value, (sup + unsup) / 2, atol=1e-6)
+
+    # Each round only reflects its own clients, nothing is carried over
+    assert trainer.updates == 2
+    assert strategy.client_weights == []
+    assert strategy.client_parameters_stack == []
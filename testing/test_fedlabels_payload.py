@@ -0,0 +1,113 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import os
+import socket
+import sys
+
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core.federated import TENSOR_DTYPES, _recv_gradients, _send_gradients
+from core.strategies.fedlabels import compress_payload, decompress_payload, flatten_to_host, unflatten_state_dict
+from utils import to_device
+
+def make_payload():
+
+    torch.manual_seed(0)
+    tensors = [torch.randn(4, 3), torch.zeros(0), torch.randn(7) * 100, torch.zeros(2)]
+    numels = [t.numel() for t in tensors]
+    return tensors, numels, torch.cat([t.reshape(-1) for t in tensors])
+
+def test_compress_none():
+
+    _, numels, flat = make_payload()
+    gradients = compress_payload(flat, 'none', numels)
+    assert decompress_payload(gradients, to_device(torch.tensor(numels))) is flat
+
+def test_compress_bf16():
+
+    _, numels, flat = make_payload()
+    gradients = compress_payload(flat, 'bf16', numels)
+    assert gradients[0].dtype == torch.bfloat16
+
+    restored = decompress_payload(gradients, to_device(torch.tensor(numels))).cpu()
+    assert restored.dtype == torch.float32
+    assert torch.all((restored - flat).abs() <= flat.abs() * 2 ** -8)
+
+def test_compress_int8():
+
+    tensors, numels, flat = make_payload()
+    quantized, scales = compress_payload(flat, 'int8', numels)
+    assert quantized.dtype == torch.int8
+    assert scales.numel() == len(tensors)
+
+    # One scale per tensor, empty and all-zero tensors included
+    for t, scale in zip(tensors, scales):
+        expected = t.abs().max() / 127 if t.numel() and t.abs().max() > 0 else torch.finfo(torch.float32).tiny
+        assert torch.isclose(scale, torch.as_tensor(expected))
+
+    restored = decompress_payload([quantized, scales], to_device(torch.tensor(numels))).cpu()
+    bound = scales.repeat_interleave(torch.tensor(numels)) / 2
+    assert torch.all((restored - flat).abs() <= bound * (1 + 1e-5))
+
+def test_flatten_round_trip():
+
+    torch.manual_seed(0)
+    state_dict = {'a': torch.randn(64, 32), 'b': torch.randn(5), 'c': torch.zeros(0), 'd': torch.randn(3, 1, 2)}
+    tensors = [to_device(value) for value in state_dict.values()]
+    layout = tuple((key, value.shape) for key, value in state_dict.items())
+
+    # Bucket smaller than a single tensor, so every tensor gets its own bucket
+    flat = flatten_to_host(tensors, bucket_cap_mb=1024 / (1024 * 1024))
+    assert not flat.is_cuda
+    assert flat.numel() == sum(value.numel() for value in state_dict.values())
+
+    restored = unflatten_state_dict(flat, layout)
+    assert list(restored) == list(state_dict)
+    for key, value in state_dict.items():
+        assert restored[key].shape == value.shape
+        assert torch.equal(restored[key], value)
+
+def run_transport(rank, port, gradients, queue):
+
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=2)
+    if rank == 1:
+        _send_gradients(gradients, 0)
+    else:
+        queue.put(_recv_gradients(1))
+    dist.barrier()
+    dist.destroy_process_group()
+
+@pytest.mark.skipif(torch.cuda.is_available(), reason='gloo round trip runs on CPU tensors only')
+def test_transport_keeps_dtypes():
+
+    gradients = [
+        torch.randn(3, 2),
+        torch.randn(5).to(torch.bfloat16),
+        torch.arange(-4, 4, dtype=torch.int8),
+        torch.tensor(2.5),
+        torch.arange(6, dtype=torch.int64),
+    ]
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+
+    ctx = mp.get_context('spawn')
+    queue = ctx.SimpleQueue()
+    mp.spawn(run_transport, args=(port, gradients, queue), nprocs=2)
+    received = queue.get()
+
+    assert len(received) == len(gradients)
+    for sent, got in zip(gradients, received):
+        expected = sent if sent.dtype in TENSOR_DTYPES else sent.float()
+        assert got.dtype == expected.dtype
+        assert got.shape == expected.shape
+        assert torch.equal(got, expected)
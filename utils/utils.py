@@ -540,6 +540,9 @@ def reshape_params_to_model(grads, model):
         offset += new_size
     return reshaped_grads
 
+# Built once, so hot loops moving tensors to host do not parse a new device each time
+CPU = torch.device('cpu')
+
 def to_device(x):
     return x.cuda() if torch.cuda.is_available() else x
 